@@ -412,7 +412,8 @@ class TokenEmbeddingsHandler:
             ] = new_embeddings
 
     def load_embeddings(self, file_path: str):
-        with safe_open(file_path, framework="pt", device=self.device.type) as f:
+        # read on CPU, _load_embeddings copies into the (GPU) embedding table
+        with safe_open(file_path, framework="pt", device="cpu") as f:
             for idx in range(len(self.text_encoders)):
                 text_encoder = self.text_encoders[idx]
                 tokenizer = self.tokenizers[idx]
@@ -1,9 +1,11 @@
+import functools
 import hashlib
 import json
 import os
-import shutil
 import subprocess
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 from weights import WeightsDownloadCache
 
@@ -26,13 +28,13 @@ from diffusers import (
     StableDiffusionXLControlNetImg2ImgPipeline,
     ControlNetModel
 )
-from diffusers.models.attention_processor import LoRAAttnProcessor2_0
+from diffusers.models.attention_processor import AttnProcessor2_0, LoRAAttnProcessor2_0
 from diffusers.pipelines.stable_diffusion.safety_checker import (
     StableDiffusionSafetyChecker,
 )
 from diffusers.utils import load_image
+from diffusers.utils.torch_utils import is_compiled_module
 from safetensors import safe_open
-from safetensors.torch import load_file
 from transformers import CLIPImageProcessor
 
 from dataset_and_utils import TokenEmbeddingsHandler
@@ -47,6 +49,32 @@ REFINER_URL = (
     "https://weights.replicate.delivery/default/sdxl/refiner-no-vae-no-encoder-1.0.tar"
 )
 SAFETY_URL = "https://weights.replicate.delivery/default/sdxl/safety-1.0.tar"
+PGET_CONCURRENCY = 16
+# PNG encoding is CPU-bound and releases the GIL, so encode outputs in parallel
+PNG_ENCODER = ThreadPoolExecutor(max_workers=4)
+# number of recently used LoRAs kept on the GPU
+LORA_CACHE_SIZE = 4
+# number of recent input images whose canny maps are kept
+CANNY_CACHE_SIZE = 16
+
+# per-request logging is off unless VERBOSE is set in the environment
+VERBOSE = bool(os.environ.get("VERBOSE"))
+
+# List of SDXL dimensions
+ALLOWED_DIMENSIONS = (
+    (512, 2048), (512, 1984), (512, 1920), (512, 1856),
+    (576, 1792), (576, 1728), (576, 1664), (640, 1600),
+    (640, 1536), (704, 1472), (704, 1408), (704, 1344),
+    (768, 1344), (768, 1280), (832, 1216), (832, 1152),
+    (896, 1152), (896, 1088), (960, 1088), (960, 1024),
+    (1024, 1024), (1024, 960), (1088, 960), (1088, 896),
+    (1152, 896), (1152, 832), (1216, 832), (1280, 768),
+    (1344, 768), (1408, 704), (1472, 704), (1536, 640),
+    (1600, 640), (1664, 576), (1728, 576), (1792, 576),
+    (1856, 512), (1920, 512), (1984, 512), (2048, 512),
+)
+_ALLOWED_DIMS_ARR = np.array(ALLOWED_DIMENSIONS, dtype=np.int32)
+_ALLOWED_RATIOS = _ALLOWED_DIMS_ARR[:, 0] / _ALLOWED_DIMS_ARR[:, 1]
 
 
 class KarrasDPM:
@@ -65,202 +93,481 @@ SCHEDULERS = {
 }
 
 
-def download_weights(url, dest):
-    start = time.time()
+def log(*args):
+    """print() for per-request details, only with VERBOSE set"""
+    if VERBOSE:
+        print(*args)
+
+
+def start_download(url, dest):
+    """Start a pget download in the background and return the process handle"""
     print("downloading url: ", url)
     print("downloading to: ", dest)
-    subprocess.check_call(["pget", "-x", url, dest], close_fds=False)
+    return subprocess.Popen(
+        ["pget", "-x", "-c", str(PGET_CONCURRENCY), url, dest], close_fds=False
+    )
+
+
+def wait_for_download(proc):
+    retcode = proc.wait()
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, proc.args)
+
+
+def download_weights(url, dest):
+    start = time.time()
+    wait_for_download(start_download(url, dest))
     print("downloading took: ", time.time() - start)
 
 
+def load_safetensors(path, device="cuda"):
+    """
+    Load a safetensors file onto the GPU one tensor at a time.
+
+    The kernel is asked to read the whole file ahead, so the mmap'd per-tensor
+    reads hit the page cache instead of faulting pages in one by one, while only
+    one tensor at a time is held in process memory. Tensors are copied from
+    pageable memory: pinning each one would leave the file's size of page-locked
+    RAM held by torch's caching host allocator.
+    """
+    with open(path, "rb") as f:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+
+    tensors = {}
+    with safe_open(path, framework="pt", device="cpu") as f:
+        for k in f.keys():
+            tensors[k] = f.get_tensor(k).to(device)
+    return tensors
+
+
+def compile_warmed_shapes(module, **compile_kwargs):
+    """
+    torch.compile a module, but only run the compiled graph for input shapes seen
+    while its `warming` flag was set. Other shapes run eagerly: on torch 2.0 every
+    captured CUDA graph keeps a private memory pool for good, and a new shape would
+    pay the full Inductor compile in the middle of a request.
+    """
+    compiled = torch.compile(module, **compile_kwargs)
+    compiled_forward = compiled.forward
+    warmed_shapes = set()
+
+    def forward(sample, *args, **kwargs):
+        shape = tuple(sample.shape)
+        if compiled.warming:
+            warmed_shapes.add(shape)
+        elif shape not in warmed_shapes:
+            return module(sample, *args, **kwargs)
+        return compiled_forward(sample, *args, **kwargs)
+
+    compiled.warming = False
+    compiled.forward = forward
+    return compiled
+
+
+def _float_timestep(module, args):
+    # dynamo guards on input dtypes too: Euler-type schedulers give float32 timesteps
+    # and DDIM/DPM/PNDM give int64 ones, so feed the warmed graphs a single dtype
+    if len(args) < 2 or not torch.is_tensor(args[1]):
+        return None
+    sample, timestep, *rest = args
+    return (sample, timestep.to(torch.float32), *rest)
+
+
+def _clone_outputs(module, args, output):
+    # reduce-overhead replays its CUDA graph into the same static output buffers on
+    # every call (torch 2.0 has no CUDA graph trees), so anything that holds on to an
+    # earlier output, like a multistep scheduler's history, would see it overwritten
+    return torch.utils._pytree.tree_map(
+        lambda x: x.clone() if isinstance(x, torch.Tensor) else x, output
+    )
+
+
+def _unit_conditioning_scale(controlnet, args, kwargs):
+    controlnet.conditioning_scale = kwargs.get("conditioning_scale", 1.0)
+    kwargs["conditioning_scale"] = 1.0
+    return args, kwargs
+
+
+def _apply_conditioning_scale(controlnet, args, kwargs, output):
+    # the ControlNet scales every residual linearly, so scaling afterwards is exact
+    scale = controlnet.conditioning_scale
+    if scale == 1.0:
+        return output
+    down_block_res_samples, mid_block_res_sample = output
+    return (
+        [sample * scale for sample in down_block_res_samples],
+        mid_block_res_sample * scale,
+    )
+
+
 class Predictor(BasePredictor):
     def load_trained_weights(self, weights, pipe):
-        print("loading custom weights")
+        log("loading custom weights")
         from no_init import no_init_or_tensor
 
         # weights can be a URLPath, which behaves in unexpected ways
         weights = str(weights)
-        #if self.tuned_weights == weights:
-            #print("skipping loading .. weights already loaded")
-            #return
-
-        self.tuned_weights = weights
+        if self.tuned_weights == weights:
+            log("skipping loading .. weights already loaded")
+            return
+        # a half-finished load leaves no weights marked as loaded
+        self.tuned_weights = None
+        # restore the base UNet weights before loading anything on top of them
+        self.unfuse_lora(pipe)
+        self.lora_procs = None
+        self.is_lora = False
+        self.tuned_model = False
 
         local_weights_cache = self.weights_cache.ensure(weights)
 
         # load UNET
-        print("Loading fine-tuned model")
-        self.is_lora = False
+        log("Loading fine-tuned model")
 
         maybe_unet_path = os.path.join(local_weights_cache, "unet.safetensors")
-        if not os.path.exists(maybe_unet_path):
-            print("Does not have Unet. assume we are using LoRA")
-            self.is_lora = True
+        is_lora = not os.path.exists(maybe_unet_path)
+        if is_lora:
+            log("Does not have Unet. assume we are using LoRA")
 
-        if not self.is_lora:
-            print("Loading Unet")
+        cached_lora_procs = self.lora_cache.get(weights) if is_lora else None
 
-            new_unet_params = load_file(
-                os.path.join(local_weights_cache, "unet.safetensors")
-            )
+        # load text
+        handler = TokenEmbeddingsHandler(
+            [pipe.text_encoder, pipe.text_encoder_2], [pipe.tokenizer, pipe.tokenizer_2]
+        )
+        handler.load_embeddings(os.path.join(local_weights_cache, "embeddings.pti"))
+
+        # load params
+        with open(os.path.join(local_weights_cache, "special_params.json"), "r") as f:
+            params = json.load(f)
+        self.token_map = params
+
+        if not is_lora:
+            log("Loading Unet")
+
+            new_unet_params = load_safetensors(maybe_unet_path)
             # this should return _IncompatibleKeys(missing_keys=[...], unexpected_keys=[])
-            pipe.unet.load_state_dict(new_unet_params, strict=False)
+            unet = pipe.unet._orig_mod if is_compiled_module(pipe.unet) else pipe.unet
+            unet.load_state_dict(new_unet_params, strict=False)
+            # the saved pre-LoRA weights belong to the previous base UNet
+            self.lora_base_weights.clear()
 
-        else:
-            print("Loading Unet LoRA")
+        elif cached_lora_procs is not None:
+            log("Using cached Unet LoRA")
+            self.lora_cache.move_to_end(weights)
+            self.lora_procs = cached_lora_procs
 
-            unet = pipe.unet
+        else:
+            log("Loading Unet LoRA")
 
-            tensors = load_file(os.path.join(local_weights_cache, "lora.safetensors"))
+            tensors = load_safetensors(
+                os.path.join(local_weights_cache, "lora.safetensors")
+            )
 
             unet_lora_attn_procs = {}
             name_rank_map = {}
+            proc_state_dicts = {}
             for tk, tv in tensors.items():
+                proc_name = ".".join(tk.split(".")[:-3])
+                param_name = ".".join(tk.split(".")[-3:])
+                proc_state_dicts.setdefault(proc_name, {})[param_name] = tv
                 # up is N, d
                 if tk.endswith("up.weight"):
-                    proc_name = ".".join(tk.split(".")[:-3])
                     r = tv.shape[1]
                     name_rank_map[proc_name] = r
 
-            for name, attn_processor in unet.attn_processors.items():
-                cross_attention_dim = (
-                    None
-                    if name.endswith("attn1.processor")
-                    else unet.config.cross_attention_dim
-                )
-                if name.startswith("mid_block"):
-                    hidden_size = unet.config.block_out_channels[-1]
-                elif name.startswith("up_blocks"):
-                    block_id = int(name[len("up_blocks.")])
-                    hidden_size = list(reversed(unet.config.block_out_channels))[
-                        block_id
-                    ]
-                elif name.startswith("down_blocks"):
-                    block_id = int(name[len("down_blocks.")])
-                    hidden_size = unet.config.block_out_channels[block_id]
-                with no_init_or_tensor():
-                    module = LoRAAttnProcessor2_0(
+            # allocate the processors directly on the GPU; no_init_or_tensor only skips
+            # nn.Linear's default reset_parameters, LoRALinearLayer still runs its own
+            # normal_/zeros_ init before the weights are overwritten from the file
+            with no_init_or_tensor(), torch.device("cuda"):
+                for name, (hidden_size, cross_attention_dim) in self._attn_proc_shapes.items():
+                    unet_lora_attn_procs[name] = LoRAAttnProcessor2_0(
                         hidden_size=hidden_size,
                         cross_attention_dim=cross_attention_dim,
                         rank=name_rank_map[name],
                     )
-                unet_lora_attn_procs[name] = module.to("cuda", non_blocking=True)
-
-            unet.set_attn_processor(unet_lora_attn_procs)
-            unet.load_state_dict(tensors, strict=False)
 
-        # load text
-        handler = TokenEmbeddingsHandler(
-            [pipe.text_encoder, pipe.text_encoder_2], [pipe.tokenizer, pipe.tokenizer_2]
-        )
-        handler.load_embeddings(os.path.join(local_weights_cache, "embeddings.pti"))
+            for name, module in unet_lora_attn_procs.items():
+                module.load_state_dict(proc_state_dicts[name])
+            self.lora_procs = unet_lora_attn_procs
 
-        # load params
-        with open(os.path.join(local_weights_cache, "special_params.json"), "r") as f:
-            params = json.load(f)
-        self.token_map = params
+            self.lora_cache[weights] = unet_lora_attn_procs
+            if len(self.lora_cache) > LORA_CACHE_SIZE:
+                self.lora_cache.popitem(last=False)
 
+        # only mark the weights as loaded once everything above succeeded
+        self.is_lora = is_lora
+        self.tuned_weights = weights
         self.tuned_model = True
 
+    def lora_layers(self, pipe):
+        """Yield (base linear, LoRA layer) pairs for every loaded LoRA projection"""
+        unet = pipe.unet._orig_mod if is_compiled_module(pipe.unet) else pipe.unet
+        for name, proc in self.lora_procs.items():
+            attn = unet.get_submodule(name[: -len(".processor")])
+            yield attn.to_q, proc.to_q_lora
+            yield attn.to_k, proc.to_k_lora
+            yield attn.to_v, proc.to_v_lora
+            yield attn.to_out[0], proc.to_out_lora
+
+    @staticmethod
+    def lora_delta(lora):
+        w_up = lora.up.weight.float()
+        if lora.network_alpha is not None:
+            w_up = w_up * lora.network_alpha / lora.rank
+        return w_up @ lora.down.weight.float()
+
+    def fuse_lora(self, pipe, lora_scale):
+        """
+        Fold the loaded LoRA into the UNet weights, so each attention projection is
+        a single GEMM instead of three. Weights are updated in place to keep the
+        parameter storage (and any captured CUDA graphs) valid.
+        """
+        if self.fused_lora_scale == lora_scale:
+            return
+        self.unfuse_lora(pipe)
+        for linear, lora in self.lora_layers(pipe):
+            weight = linear.weight.data
+            if linear not in self.lora_base_weights:
+                base = torch.empty_like(weight, device="cpu", pin_memory=True)
+                self.lora_base_weights[linear] = base.copy_(weight)
+            weight.copy_(weight.float() + lora_scale * self.lora_delta(lora))
+        self.fused_lora_scale = lora_scale
+
+    def unfuse_lora(self, pipe):
+        # restore the saved copies, subtracting the delta again would round the
+        # half-precision weights a little further away on every scale or LoRA switch
+        if self.fused_lora_scale is None:
+            return
+        for linear, base in self.lora_base_weights.items():
+            linear.weight.data.copy_(base, non_blocking=True)
+        self.fused_lora_scale = None
+
+    def attn_proc_shapes(self, unet):
+        """Map each attention processor name to its (hidden_size, cross_attention_dim)"""
+        shapes = {}
+        for name in unet.attn_processors.keys():
+            cross_attention_dim = (
+                None
+                if name.endswith("attn1.processor")
+                else unet.config.cross_attention_dim
+            )
+            if name.startswith("mid_block"):
+                hidden_size = unet.config.block_out_channels[-1]
+            elif name.startswith("up_blocks"):
+                block_id = int(name[len("up_blocks.")])
+                hidden_size = list(reversed(unet.config.block_out_channels))[
+                    block_id
+                ]
+            elif name.startswith("down_blocks"):
+                block_id = int(name[len("down_blocks.")])
+                hidden_size = unet.config.block_out_channels[block_id]
+            shapes[name] = (hidden_size, cross_attention_dim)
+        return shapes
+
     def setup(self, weights: Optional[Path] = None):
         """Load the model into memory to make running multiple predictions efficient"""
         start = time.time()
         self.tuned_model = False
         self.tuned_weights = None
+        self.lora_procs = None
+        # LoRA processors already built on the GPU, keyed by weights URL
+        self.lora_cache = OrderedDict()
+        self.fused_lora_scale = None
+        # pre-LoRA weights of the fused projections, kept on the host
+        self.lora_base_weights = {}
+        # bf16 has fp32's exponent range and runs at fp16 speed on Ampere and newer
+        self.dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
         if str(weights) == "weights":
             weights = None
 
         self.weights_cache = WeightsDownloadCache()
 
-        print("Loading safety checker...")
-        if not os.path.exists(SAFETY_CACHE):
-            download_weights(SAFETY_URL, SAFETY_CACHE)
-        self.safety_checker = StableDiffusionSafetyChecker.from_pretrained(
-            SAFETY_CACHE, torch_dtype=torch.float16
-        ).to("cuda")
-        self.feature_extractor = CLIPImageProcessor.from_pretrained(FEATURE_EXTRACTOR)
-
-        if not os.path.exists(SDXL_MODEL_CACHE):
-            download_weights(SDXL_URL, SDXL_MODEL_CACHE)
+        # kick off all missing downloads up front so they overlap with local loading
+        downloads = {}
+        for url, dest in (
+            (SAFETY_URL, SAFETY_CACHE),
+            (SDXL_URL, SDXL_MODEL_CACHE),
+            (REFINER_URL, REFINER_MODEL_CACHE),
+        ):
+            if not os.path.exists(dest):
+                downloads[dest] = start_download(url, dest)
 
+        self.feature_extractor = CLIPImageProcessor.from_pretrained(FEATURE_EXTRACTOR)
         controlnet = ControlNetModel.from_pretrained(
             CONTROL_CACHE,
-            torch_dtype=torch.float16,
+            torch_dtype=self.dtype,
         )
 
+        print("Loading safety checker...")
+        if SAFETY_CACHE in downloads:
+            wait_for_download(downloads[SAFETY_CACHE])
+        self.safety_checker = StableDiffusionSafetyChecker.from_pretrained(
+            SAFETY_CACHE, torch_dtype=self.dtype
+        ).to("cuda")
+
         print("Loading SDXL Controlnet pipeline...")
+        if SDXL_MODEL_CACHE in downloads:
+            wait_for_download(downloads[SDXL_MODEL_CACHE])
         self.control_text2img_pipe = StableDiffusionXLControlNetPipeline.from_pretrained(
             SDXL_MODEL_CACHE,
             controlnet=controlnet,
-            torch_dtype=torch.float16,
+            torch_dtype=self.dtype,
             use_safetensors=True,
             variant="fp16",
         )
         self.control_text2img_pipe.to("cuda")
+        # the fp16-fix VAE doesn't overflow in half precision, so stop the pipeline
+        # from upcasting it to fp32 when running in fp16 (it never casts back when
+        # output_type="latent")
+        self.control_text2img_pipe.vae.register_to_config(force_upcast=False)
+        # decode one image at a time to cap peak VRAM; the refiner shares this VAE.
+        # No tiling: diffusers tiles any side over 1024px, i.e. almost every bucket,
+        # which decodes extra overlap and blends visible seams
+        self.control_text2img_pipe.enable_vae_slicing()
+        self._base_scheduler_config = self.control_text2img_pipe.scheduler.config
+        self._scheduler_cache = {}
+        self.generator = torch.Generator("cuda")
+        self.canny_cache = OrderedDict()
+        # the UNet topology is fixed, so LoRA loads only need a lookup
+        self._attn_proc_shapes = self.attn_proc_shapes(self.control_text2img_pipe.unet)
         self.is_lora = False
         if weights or os.path.exists("./trained-model"):
             self.load_trained_weights(weights, self.control_text2img_pipe)
 
-        if not os.path.exists(REFINER_MODEL_CACHE):
-            download_weights(REFINER_URL, REFINER_MODEL_CACHE)
+        pipe = self.control_text2img_pipe
+        # NHWC convs + fused SDPA (flash / mem-efficient) attention; cuDNN autotunes
+        # once per resolution bucket
+        torch.backends.cuda.enable_flash_sdp(True)
+        torch.backends.cuda.enable_mem_efficient_sdp(True)
+        torch.backends.cudnn.benchmark = True
+        for module in (pipe.unet, pipe.controlnet, pipe.vae):
+            module.to(memory_format=torch.channels_last)
+            module.set_attn_processor(AttnProcessor2_0())
+
+        print("Compiling UNet and ControlNet...")
+        # compile static shapes, with a graph (and captured CUDA graph) only for the
+        # shapes the warmup below runs; with the LoRA fused into its weights the UNet
+        # traces as a single graph
+        pipe.unet = compile_warmed_shapes(
+            pipe.unet, mode="reduce-overhead", fullgraph=True, dynamic=False
+        )
+        pipe.unet.register_forward_pre_hook(_float_timestep)
+        pipe.unet.register_forward_hook(_clone_outputs)
+        pipe.controlnet = compile_warmed_shapes(
+            pipe.controlnet, mode="reduce-overhead", fullgraph=False, dynamic=False
+        )
+        pipe.controlnet.register_forward_pre_hook(_float_timestep)
+        # dynamo bakes python floats into the graph, so a new condition_scale would
+        # recompile and re-capture; run the graph at scale 1.0 and scale outside it
+        pipe.controlnet.register_forward_pre_hook(
+            _unit_conditioning_scale, with_kwargs=True
+        )
+        pipe.controlnet.register_forward_hook(_apply_conditioning_scale, with_kwargs=True)
+        # the VAE upcasts conditionally, so leave graph breaks allowed; the refiner
+        # shares this VAE and reuses the compiled decoder
+        pipe.vae.decoder = compile_warmed_shapes(
+            pipe.vae.decoder, mode="reduce-overhead", dynamic=False
+        )
+        # with slicing, every image in a batch is decoded by a separate replay
+        pipe.vae.decoder.register_forward_hook(_clone_outputs)
+        self.warmup(pipe)
 
         print("Loading refiner pipeline...")
+        if REFINER_MODEL_CACHE in downloads:
+            wait_for_download(downloads[REFINER_MODEL_CACHE])
         self.refiner = DiffusionPipeline.from_pretrained(
             REFINER_MODEL_CACHE,
             text_encoder_2=self.control_text2img_pipe.text_encoder_2,
             vae=self.control_text2img_pipe.vae,
-            torch_dtype=torch.float16,
+            torch_dtype=self.dtype,
             use_safetensors=True,
             variant="fp16",
         )
-        self.refiner.to("cuda")
+        # the VAE and second text encoder are shared and already on the GPU, only the
+        # refiner's own UNet still needs moving
+        assert self.refiner.vae is self.control_text2img_pipe.vae
+        assert self.refiner.text_encoder_2 is self.control_text2img_pipe.text_encoder_2
+        self.refiner.unet.to("cuda")
         print("setup took: ", time.time() - start)
 
+    @torch.inference_mode()
+    def warmup(self, pipe):
+        """
+        Trigger the torch.compile graph capture for the default request (1024x1024,
+        one output) so it doesn't pay for it; other shapes run eagerly.
+        """
+        start = time.time()
+        compiled = (pipe.unet, pipe.controlnet, pipe.vae.decoder)
+        for module in compiled:
+            module.warming = True
+        try:
+            pipe(
+                prompt="a",
+                image=Image.new("RGB", (1024, 1024)),
+                width=1024,
+                height=1024,
+                num_inference_steps=2,
+            )
+        finally:
+            for module in compiled:
+                module.warming = False
+        print("warmup took: ", time.time() - start)
+
+    def get_scheduler(self, name):
+        """Build each scheduler once, set_timesteps() resets its state on every call"""
+        if name not in self._scheduler_cache:
+            self._scheduler_cache[name] = SCHEDULERS[name].from_config(
+                self._base_scheduler_config
+            )
+        return self._scheduler_cache[name]
+
     def load_image(self, path):
-        shutil.copyfile(path, "/tmp/image.png")
-        return load_image("/tmp/image.png").convert("RGB")
+        # diffusers' load_image takes local paths and URLs directly and returns RGB
+        return load_image(str(path))
     
     def resize_image(self, image):
         image_width, image_height = image.size
-        print("Original width:"+str(image_width)+", height:"+str(image_height))
+        log("Original width:"+str(image_width)+", height:"+str(image_height))
+        log(f"Aspect Ratio: {image_width / image_height:.2f}")
         new_width, new_height = self.resize_to_allowed_dimensions(image_width, image_height)
-        print("new_width:"+str(new_width)+", new_height:"+str(new_height))
-        image = image.resize((new_width, new_height))
+        log("new_width:"+str(new_width)+", new_height:"+str(new_height))
+        # resize the array cv2.Canny consumes directly, skipping a PIL round-trip;
+        # INTER_AREA antialiases when shrinking like PIL's default BICUBIC does, so
+        # Canny doesn't pick up aliasing as extra edges
+        shrinking = new_width * new_height < image_width * image_height
+        image = cv2.resize(
+            np.asarray(image),
+            (new_width, new_height),
+            interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_CUBIC,
+        )
         return image, new_width, new_height
     
-    def resize_to_allowed_dimensions(self, width, height):
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def resize_to_allowed_dimensions(width, height):
         """
         Function re-used from Lucataco's implementation of SDXL-Controlnet for Replicate
         """
-        # List of SDXL dimensions
-        allowed_dimensions = [
-            (512, 2048), (512, 1984), (512, 1920), (512, 1856),
-            (576, 1792), (576, 1728), (576, 1664), (640, 1600),
-            (640, 1536), (704, 1472), (704, 1408), (704, 1344),
-            (768, 1344), (768, 1280), (832, 1216), (832, 1152),
-            (896, 1152), (896, 1088), (960, 1088), (960, 1024),
-            (1024, 1024), (1024, 960), (1088, 960), (1088, 896),
-            (1152, 896), (1152, 832), (1216, 832), (1280, 768),
-            (1344, 768), (1408, 704), (1472, 704), (1536, 640),
-            (1600, 640), (1664, 576), (1728, 576), (1792, 576),
-            (1856, 512), (1920, 512), (1984, 512), (2048, 512)
-        ]
-        # Calculate the aspect ratio
-        aspect_ratio = width / height
-        print(f"Aspect Ratio: {aspect_ratio:.2f}")
         # Find the closest allowed dimensions that maintain the aspect ratio
-        closest_dimensions = min(
-            allowed_dimensions,
-            key=lambda dim: abs(dim[0] / dim[1] - aspect_ratio)
-        )
-        return closest_dimensions
+        idx = int(np.argmin(np.abs(_ALLOWED_RATIOS - width / height)))
+        return ALLOWED_DIMENSIONS[idx]
 
     def image2canny(self, image):
-        image = np.array(image)
-        image = cv2.Canny(image, 100, 200)
-        image = image[:, :, None]
-        image = np.concatenate([image, image, image], axis=2)
-        return Image.fromarray(image)
+        edges = cv2.Canny(np.asarray(image), 100, 200)
+        # SIMD gray -> RGB expansion straight into the output buffer
+        return Image.fromarray(cv2.cvtColor(edges, cv2.COLOR_GRAY2RGB))
+
+    def cached_canny(self, image):
+        """image2canny, memoized on the resized pixels (retries often reuse the input)"""
+        key = (image.shape, hashlib.blake2b(image.data, digest_size=16).digest())
+        if key in self.canny_cache:
+            self.canny_cache.move_to_end(key)
+            return self.canny_cache[key]
+        canny = self.image2canny(image)
+        self.canny_cache[key] = canny
+        if len(self.canny_cache) > CANNY_CACHE_SIZE:
+            self.canny_cache.popitem(last=False)
+        return canny
 
     def run_safety_checker(self, image):
         safety_checker_input = self.feature_extractor(image, return_tensors="pt").to(
@@ -269,7 +576,7 @@ class Predictor(BasePredictor):
         np_image = [np.array(val) for val in image]
         image, has_nsfw_concept = self.safety_checker(
             images=np_image,
-            clip_input=safety_checker_input.pixel_values.to(torch.float16),
+            clip_input=safety_checker_input.pixel_values.to(self.dtype),
         )
         return image, has_nsfw_concept
 
@@ -346,20 +653,16 @@ class Predictor(BasePredictor):
         if lora_weights:
             self.load_trained_weights(lora_weights, self.control_text2img_pipe)
 
-        # OOMs can leave vae in bad state
-        if self.control_text2img_pipe.vae.dtype == torch.float32:
-            self.control_text2img_pipe.vae.to(dtype=torch.float16)
-
         sdxl_kwargs = {}
         if self.tuned_model:
             # consistency with fine-tuning API
             for k, v in self.token_map.items():
                 prompt = prompt.replace(k, v)
-        print(f"Prompt: {prompt}")
+        log(f"Prompt: {prompt}")
         image = self.load_image(image)
         image, width, height = self.resize_image(image)
-        print("txt2img mode")
-        sdxl_kwargs["image"] = self.image2canny(image)
+        log("txt2img mode")
+        sdxl_kwargs["image"] = self.cached_canny(image)
         sdxl_kwargs["controlnet_conditioning_scale"] = condition_scale
         sdxl_kwargs["width"] = width
         sdxl_kwargs["height"] = height
@@ -374,8 +677,8 @@ class Predictor(BasePredictor):
             pipe.watermark = None
             self.refiner.watermark = None
 
-        pipe.scheduler = SCHEDULERS[scheduler].from_config(pipe.scheduler.config)
-        generator = torch.Generator("cuda").manual_seed(seed)
+        pipe.scheduler = self.get_scheduler(scheduler)
+        generator = self.generator.manual_seed(seed)
 
         common_args = {
             "prompt": [prompt] * num_outputs,
@@ -386,7 +689,7 @@ class Predictor(BasePredictor):
         }
 
         if self.is_lora:
-            sdxl_kwargs["cross_attention_kwargs"] = {"scale": lora_scale}
+            self.fuse_lora(pipe, lora_scale)
 
         output = pipe(**common_args, **sdxl_kwargs)
 
@@ -406,13 +709,19 @@ class Predictor(BasePredictor):
         _, has_nsfw_content = self.run_safety_checker(output.images)
 
         output_paths = []
+        saves = []
         for i, nsfw in enumerate(has_nsfw_content):
             if nsfw:
                 print(f"NSFW content detected in image {i}")
                 continue
             output_path = f"/tmp/out-{i}.png"
-            output.images[i].save(output_path)
+            # zlib level 1 encodes ~3x faster than the default for slightly larger files
+            saves.append(
+                PNG_ENCODER.submit(output.images[i].save, output_path, compress_level=1)
+            )
             output_paths.append(Path(output_path))
+        for save in saves:
+            save.result()
 
         if len(output_paths) == 0:
             raise Exception(
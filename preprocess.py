@@ -36,6 +36,7 @@ BLIP_URL = "https://weights.replicate.delivery/default/blip_large/blip_large.tar
 BLIP_PROCESSOR_URL = "https://weights.replicate.delivery/default/blip_processor/blip_processor.tar"
 BLIP_PATH = "./blip-cache"
 BLIP_PROCESSOR_PATH = "./blip-proc-cache"
+BLIP_BATCH_SIZE = 16
 
 # model is fixed to CIDAS/clipseg-rd64-refined
 CLIPSEG_URL = "https://weights.replicate.delivery/default/clip_seg_rd64_refined/clip_seg_rd64_refined.tar"
@@ -245,23 +246,35 @@ def blip_captioning_dataset(
         download_weights(BLIP_PROCESSOR_URL, BLIP_PROCESSOR_PATH)
     if not os.path.exists(BLIP_PATH):
         download_weights(BLIP_URL, BLIP_PATH)
+    dtype = torch.float16 if torch.device(device).type == "cuda" else torch.float32
     processor = BlipProcessor.from_pretrained(BLIP_PROCESSOR_PATH)
-    model = BlipForConditionalGeneration.from_pretrained(BLIP_PATH).to(device)
-    captions = []
+    model = BlipForConditionalGeneration.from_pretrained(
+        BLIP_PATH, torch_dtype=dtype
+    ).to(device)
+    model.eval()
     text = text.strip()
     print(f"Input captioning text: {text}")
-    for image in tqdm(images):
-        inputs = processor(image, return_tensors="pt").to("cuda")
+    raw_captions = []
+    batches = range(0, len(images), BLIP_BATCH_SIZE)
+    for i in tqdm(batches, disable=len(batches) == 1):
+        inputs = processor(
+            images[i : i + BLIP_BATCH_SIZE], return_tensors="pt"
+        ).to(device, dtype)
         out = model.generate(
-            **inputs, max_length=150, do_sample=True, top_k=50, temperature=0.7
+            **inputs,
+            max_length=150,
+            num_beams=1,
+            do_sample=True,
+            top_k=50,
+            temperature=0.7,
         )
-        caption = processor.decode(out[0], skip_special_tokens=True)
+        raw_captions.extend(processor.batch_decode(out, skip_special_tokens=True))
 
+    captions = []
+    for caption in raw_captions:
         # BLIP 2 lowercases all caps tokens. This should properly replace them w/o messing up subwords. I'm sure there's a better way to do this.
         for token in substitution_tokens:
-            print(token)
             sub_cap = " " + caption + " "
-            print(sub_cap)
             sub_cap = sub_cap.replace(" " + token.lower() + " ", " " + token + " ")
             caption = sub_cap.strip()
 